@@ -11,6 +11,8 @@ httpcopy 配合 tcpflow 工作，方法是：
 
 * 启用 tcpflow 监听生产服务器：`tcpflow -i eth1 host 192.168.1.132 and port 80`
 * 运行 httpcopy：`httpcopy -l 192.168.1.132:80 -f 192.168.1.104:80`
+* 安装了 inotify_simple（仅 Linux）时通过 inotify 监视数据文件的变化，否则自动改为定时扫描数据目录
+* 数据目录在 NFS 等不支持 inotify 的文件系统上时，用 `-p/--poll` 强制使用定时扫描
 
 httpcopy 转发数据的流程：
 
@@ -24,7 +26,6 @@ httpcopy 转发数据的流程：
 * httpcopy 只进行数据转发，没有进行 http 协议的分析，无法完全模拟 http 的一发一收的过程
 """
 import argparse
-import glob
 import os
 import re
 import socket
@@ -32,17 +33,33 @@ import threading
 import time
 import logging
 
+try:
+    import inotify_simple
+except ImportError:     # 非 Linux 平台，使用轮询方式
+    inotify_simple = None
+
 DEFAULT_URL_PREFIX = ''
 
 FORWARD_CONN_TIMEOUT = 2    # 转发连接超时
 FORWARD_DATA_TIMEOUT = 5    # 转发数据超时
+FORWARD_RECV_SIZE = 256 * 1024      # 每次接收数据的大小
+FORWARD_RCVBUF = 10 * 1024 * 1024   # 转发连接的接收缓冲区大小
+FORWARD_SNDBUF = 1 * 1024 * 1024    # 转发连接的发送缓冲区大小
+
+FIRSTLINE_SIZE = 2048   # 检查 http 请求、响应时读取的最大长度
+
+RE_HTTP_REQ = re.compile(rb'([A-Z]{3,8}) ([^ ]+) (HTTP/1\.[01])')
+RE_HTTP_RESP = re.compile(rb'(HTTP/1\.[01]) (\d{3}) (.*)')
 
-RE_HTTP_REQ = re.compile('([A-Z]{3,8}) ([^ ]+) (HTTP/1\.[01])')
-RE_HTTP_RESP = re.compile('(HTTP/1.[01]) (\d{3}) (.*)')
+# tcpflow 输出的文件名格式
+RE_TCPFLOW_FILE = re.compile(r'\d{3}\.\d{3}\.\d{3}\.\d{3}\.\d{5}-\d{3}\.\d{3}\.\d{3}\.\d{3}\.\d{5}')
+ADDR_LEN = 21   # 文件名中每个地址的长度，如 192.168.001.132.00080
 
 config = argparse.Namespace()
 logger = logging.Logger
 
+mtimes = None   # 由 inotify 维护的文件修改时间 {文件名: 修改时间}，None 表示使用轮询方式
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -71,6 +88,9 @@ def parse_args():
                         metavar='DIR',
                         default='.',
                         help='数据目录.')
+    parser.add_argument('-p', '--poll',
+                        action='store_true',
+                        help='使用轮询方式检测文件变化(用于 NFS 等不支持 inotify 的文件系统).')
     return parser.parse_args()
 
 
@@ -85,18 +105,21 @@ def parse_hostport(hostport, default_port=80):
 
 
 def format_hostport(host, port):
-    f1, f2, f3, f4 = map(int, host.split('.'))
-    return '{:03d}.{:03d}.{:03d}.{:03d}.{:05d}'.format(f1, f2, f3, f4,port)
+    f1, f2, f3, f4 = host.split('.')
+    return '{:0>3}.{:0>3}.{:0>3}.{:0>3}.{:05d}'.format(f1, f2, f3, f4, port)
 
 
 def read_firstline(fn):
-    return open(fn, encoding='iso=8859-1').readline(2048)
+    # 不使用缓冲，只读取一次，避免为了一行数据读取整个缓冲区
+    with open(fn, 'rb', buffering=0) as fp:
+        return fp.read(FIRSTLINE_SIZE).split(b'\n', 1)[0]
 
 
 def check_http_files(ready_files):
     invalid_files = []
     http_files = []
     invalid_url_files = []  # 过滤掉的文件
+    url_prefix = config.url_prefix_b
     for fn, peer_fn in ready_files:
         line = read_firstline(fn)
         peer_line = read_firstline(peer_fn)
@@ -108,25 +131,24 @@ def check_http_files(ready_files):
             continue
 
         # 检查哪个文件是 http 请求，哪个文件是 http 响应
-        if RE_HTTP_REQ.match(line) and RE_HTTP_RESP.match(peer_line):
-            request_line = line
-            request_file = fn
-            response_file = peer_fn
-        elif RE_HTTP_REQ.match(peer_line) and RE_HTTP_RESP.match(line):
-            request_line = peer_line
-            request_file = peer_fn
-            response_file = fn
+        # 先根据响应行的开头区分方向，再分别用正则表达式验证
+        if peer_line.startswith(b'HTTP/'):
+            request_line, response_line = line, peer_line
+            request_file, response_file = fn, peer_fn
         else:
+            request_line, response_line = peer_line, line
+            request_file, response_file = peer_fn, fn
+        if not (RE_HTTP_REQ.match(request_line) and RE_HTTP_RESP.match(response_line)):
             invalid_files.append(fn)
             invalid_files.append(peer_fn)
             continue
 
-        url = request_line.split(' ')[1]
-        if config.url_prefix and not url.startswith(config.url_prefix):
+        # 没有设置 URL 前缀时（默认）不需要提取 URL
+        if url_prefix and not request_line.split(b' ')[1].startswith(url_prefix):
             invalid_url_files.append(fn)
             invalid_url_files.append(peer_fn)
         else:
-            logger.info('转发: %s', request_line.rstrip())
+            logger.info('转发: %s', request_line.rstrip().decode('iso-8859-1'))
             http_files.append((request_file, response_file))
 
     move_files(invalid_url_files, config.data_dir_invalid_url)
@@ -135,33 +157,68 @@ def check_http_files(ready_files):
 
 
 def move_files(invalid_files, data_dir):
+    base = data_dir + os.sep
     for fn in invalid_files:
-        os.rename(fn, os.path.join(data_dir, fn))
-
-
-def forward(request_file, response_file):
-    with socket.socket() as sock:
-        sock.settimeout(FORWARD_CONN_TIMEOUT)
+        os.rename(fn, base + fn)
+
+
+def open_connection():
+    """建立到测试服务器的连接，失败时返回 None"""
+    sock = socket.socket()
+    # 在连接前设置，以便 TCP 握手时协商足够大的窗口
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FORWARD_RCVBUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FORWARD_SNDBUF)
+    # 请求是一次性发出的，不需要 Nagle 算法再等待
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(FORWARD_CONN_TIMEOUT)
+    try:
+        sock.connect(config.forward)
+        return sock
+    except socket.timeout:
+        logger.info('连接超时: %s', config.forward)
+    except OSError as e:
+        logger.info('无法连接: %s, %s', config.forward, e)
+    sock.close()
+    return None
+
+
+def exchange(sock, request_file, fp):
+    """发送请求，把响应写入 fp"""
+    sock.settimeout(FORWARD_CONN_TIMEOUT)
+    # TCP_CORK(仅 Linux)：发送完成前不发出不完整的报文段，
+    # sendfile 不可用、退回逐块 send 时也能合并成完整的报文段
+    cork = hasattr(socket, 'TCP_CORK')
+    if cork:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    with open(request_file, 'rb') as req:
+        sock.sendfile(req)  # 可用时使用 os.sendfile，不经过用户空间复制
+    if cork:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+    sock.settimeout(FORWARD_DATA_TIMEOUT)
+    while True:
         try:
-            sock.connect(config.forward)
+            data = sock.recv(FORWARD_RECV_SIZE)
         except socket.timeout:
-            logger.info('连接超时: %s', config.forward)
             return
-        except ConnectionRefusedError as e:
-            logger.info('无法连接: %s, %s', config.forward, e)
+        if not data:
             return
-        for line in open(request_file, 'rb'):
-            sock.send(line)
-        sock.settimeout(FORWARD_DATA_TIMEOUT)
-        while True:
+        fp.write(data)
+
+
+def forward(request_file, response_file):
+    # 没有分析 http 协议，无法知道响应何时结束，所以每次都使用新连接
+    sock = open_connection()
+    if sock is None:
+        return
+    try:
+        with sock, open(response_file, 'ab') as fp:
             try:
-                data = sock.recv(1024)
-            except socket.timeout:
-                break
-            if not data:
-                break
-            with open(response_file, 'ab') as fp:
-                fp.write(data)
+                exchange(sock, request_file, fp)
+            except OSError as e:
+                logger.info('转发失败: %s, %s', config.forward, e)
+    except Exception:
+        # 在线程中运行，异常需要记录下来，否则只会输出到 stderr
+        logger.exception('转发出错: %s', request_file)
 
 
 def process_http_files(request_file, response_file):
@@ -174,40 +231,119 @@ def process_http_files(request_file, response_file):
     os.rename(request_file, new_request_file)
     os.rename(response_file, new_response_file)
 
-    t = threading.Thread(target=forward, args=(new_request_file, forward_response_file))
-    t.setDaemon(True)
+    # 转发要等到 FORWARD_DATA_TIMEOUT 才结束，不限制线程数，以免限制转发速度；
+    # 使用 daemon 线程，退出时不用等待未完成的转发
+    t = threading.Thread(target=forward, args=(new_request_file, forward_response_file), daemon=True)
     t.start()
 
 
+def scan_files():
+    """扫描所有符合 tcpflow 输出格式的文件，返回 {文件名: 修改时间}"""
+    with os.scandir('.') as it:
+        return { entry.name: entry.stat().st_mtime for entry in it
+                 if RE_TCPFLOW_FILE.fullmatch(entry.name) }
+
+
+def update_mtimes(events):
+    """根据 inotify 事件更新文件修改时间，返回是否有文件新建或修改"""
+    now = time.time()
+    changed = False
+    removed = inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM
+    for event in events:
+        if event.mask & inotify_simple.flags.Q_OVERFLOW:
+            # 事件队列溢出，丢失了部分事件，重新扫描
+            logger.info('inotify 事件队列溢出，重新扫描数据文件.')
+            mtimes.clear()
+            mtimes.update(scan_files())
+            changed = True
+            continue
+        if not RE_TCPFLOW_FILE.fullmatch(event.name):
+            continue
+        if event.mask & removed:
+            mtimes.pop(event.name, None)
+        else:
+            mtimes[event.name] = now
+            changed = True
+    return changed
+
+
+def start_watch():
+    """启用 inotify 监视数据文件变化，不用每次都扫描目录"""
+    global mtimes
+
+    flags = inotify_simple.flags
+    inotify = inotify_simple.INotify()
+    # 先监视再扫描，避免遗漏扫描期间发生的变化
+    inotify.add_watch('.', flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                           flags.CREATE | flags.DELETE | flags.MODIFY)
+    mtimes = scan_files()
+    return inotify
+
+
+def wait_files(inotify, deadline):
+    """等待到 deadline 有文件可能超时为止（至少等待检测间隔），期间根据 inotify 事件更新文件修改时间
+
+    deadline 为 None 表示没有等待超时的文件。
+    新事件只会让文件的修改时间变晚，所以不需要重新计算 deadline。
+    """
+    earliest = time.time() + config.interval
+    while True:
+        if deadline is None:
+            # 没有等待超时的文件，一直等到有文件变化
+            timeout = None
+        else:
+            timeout = max(deadline, earliest) - time.time()
+            if timeout <= 0:
+                return
+            timeout *= 1000
+        if update_mtimes(inotify.read(timeout=timeout)) and deadline is None:
+            deadline = time.time() + config.timeout
+
+
 def process():
+    """处理所有超时的文件，返回下一个文件可能超时的时间，没有等待超时的文件时返回 None"""
     now = time.time()
     timeout = config.timeout
-    listen_server = format_hostport(*config.listen)
-
-    # 所有符合 tcpflow 输出格式的文件名
-    all_files = glob.glob('???.???.???.???.?????-???.???.???.???.?????')
-    valid_files = [ fn for fn in all_files
-                    if fn.startswith(listen_server) or fn.endswith(listen_server) ]
+    listen_server = config.listen_server
+
+    # 所有符合 tcpflow 输出格式的文件及其修改时间
+    file_mtimes = scan_files() if mtimes is None else mtimes
+    valid_files = []
+    invalid_server_files = []
+    for fn in file_mtimes:
+        if fn[:ADDR_LEN] == listen_server or fn[ADDR_LEN + 1:] == listen_server:
+            valid_files.append(fn)
+        else:
+            invalid_server_files.append(fn)
 
     # 处理无效文件
-    invalid_server_files = set(all_files) - set(valid_files)
     move_files(invalid_server_files, config.data_dir_invalid_server)
 
     # 检查文件修改时间
-    mtimes = { fn: os.stat(fn).st_mtime for fn in valid_files }
-    timeout_files = [ fn for fn in valid_files
-                      if now - mtimes[fn] > timeout ]
+    timeout_files = []
+    earliest_mtime = None
+    for fn in valid_files:
+        mtime = file_mtimes[fn]
+        if now - mtime > timeout:
+            timeout_files.append(fn)
+        elif earliest_mtime is None or mtime < earliest_mtime:
+            earliest_mtime = mtime
 
     # 根据数据流方向过滤文件
     ready_files = []
     invalid_oneway_files = []
-    while timeout_files:
-        fn = timeout_files.pop(0)
-        peer_fn = '{1}-{0}'.format(*fn.split('-'))
-        if peer_fn in timeout_files:
-            timeout_files.remove(peer_fn)
+    pending = set(timeout_files)
+    for fn in timeout_files:
+        if fn not in pending:
+            # 已经和另一个方向的文件配对
+            continue
+        pending.discard(fn)
+        # 文件名已经由 RE_TCPFLOW_FILE 保证是定长的
+        peer_fn = fn[ADDR_LEN + 1:] + '-' + fn[:ADDR_LEN]
+        if peer_fn in pending:
+            pending.discard(peer_fn)
             ready_files.append((fn, peer_fn))
-        elif peer_fn in all_files:
+        elif peer_fn in file_mtimes:
             # 另一个方向还有数据，暂不处理
             pass
         else:
@@ -224,10 +360,14 @@ def process():
     for request_file, response_file in http_files:
         process_http_files(request_file, response_file)
 
+    return None if earliest_mtime is None else earliest_mtime + timeout
+
 
 def httpcopy():
     config.listen = parse_hostport(config.listen)
+    config.listen_server = format_hostport(*config.listen)
     config.forward = parse_hostport(config.forward)
+    config.url_prefix_b = config.url_prefix.encode()
 
     config.data_dir_forward = os.path.join(config.data_dir, 'forward')
     config.data_dir_invalid = os.path.join(config.data_dir, 'invalid')
@@ -241,12 +381,19 @@ def httpcopy():
     os.makedirs(config.data_dir_invalid_server, exist_ok=True)
     os.makedirs(config.data_dir_invalid_url, exist_ok=True)
 
+    # 只运行一次时不需要监视
+    inotify = None
+    if inotify_simple and config.interval and not config.poll:
+        inotify = start_watch()
+
     while True:
-        process()
-        if config.interval:
-            time.sleep(config.interval)
-        else:
+        deadline = process()
+        if not config.interval:
             break
+        if inotify:
+            wait_files(inotify, deadline)
+        else:
+            time.sleep(config.interval)
 
 
 if __name__ == "__main__":